@@ -1,7 +1,14 @@
 ﻿import streamlit as st
-import json
+import mmap
+import orjson # Faster JSON parsing/serialization than the stdlib json module
 import os
+import re
+import pandas as pd
 import requests # Added for Ollama interaction
+from collections import defaultdict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import time # For simple connection check backoff
 
@@ -12,33 +19,136 @@ OCCUPANCY_FILE = DATA_DIR / "occupancy.json"
 DESKS_FILE = DATA_DIR / "desks.json"
 EMPLOYEE_PREFS_FILE = DATA_DIR / "employee_preferences.json" # Not used in this specific query logic, but loaded for future use
 POLICIES_FILE = DATA_DIR / "policies.json"
+DEFAULT_CAPACITY_THRESHOLD = 80 # Forecast occupancy (%) limit used if POL-005 is missing or has no numeric limit
+PARALLEL_CHECK_MIN_DESKS = 64 # Above this many candidates, availability checks run in a thread pool
+AVAILABILITY_CHECK_WORKERS = 8
 
 # --- Ollama Configuration ---
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate") # Default Ollama API endpoint
-OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "phi3:mini") # Changed from llama3 due to timeout issues - Default model - make sure you have pulled this model (ollama pull llama3)
+OLLAMA_CHAT_URL = OLLAMA_API_URL.replace("/api/generate", "/api/chat") # Chat endpoint lets the system prompt be sent as a separate, cacheable message
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen2.5:0.5b-instruct-q4_K_M") # Small quantized model is plenty for slot filling - make sure you have pulled this model (ollama pull qwen2.5:0.5b-instruct-q4_K_M)
 NLP_ENABLED = False # Flag to indicate if NLP service is available
+OLLAMA_CONNECT_TIMEOUT = 5 # Seconds to establish the TCP connection to Ollama
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "24h") # Keep the model loaded between queries
+# Generation options: the structured query is ~40 tokens, so cap the output and decode greedily
+# (deterministic, which also lets the query cache hit more often). The context size is fixed so the
+# cached prompt prefix stays valid between calls.
+OLLAMA_OPTIONS = {
+    "num_predict": 96,
+    "temperature": 0.0,
+    "top_k": 1,
+    "top_p": 1.0,
+    "num_ctx": 1024,
+    "stop": ["\n\n"],
+}
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "1")) # Match the server's OLLAMA_NUM_PARALLEL to extract query fields concurrently
+
+# Fields extracted from the natural language query, with hints for the per-field prompts
+QUERY_FIELDS = {
+    "desk_type": '(e.g., "standing", "regular")',
+    "location_proximity": '(e.g., "marketing team", "window", "quiet area") - the target of proximity',
+    "floor": '(e.g., "3rd", "2nd", number)',
+    "time_request": '(e.g., "tomorrow afternoon", "now", "next Monday morning")',
+    "specific_features": '(e.g., ["dual-monitor", "ergonomic-chair"]) - list any specific equipment mentioned',
+}
+
+# JSON schema passed as Ollama's `format` so decoding is constrained to valid structured queries
+QUERY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "desk_type": {"type": "string"},
+        "location_proximity": {"type": "string"},
+        "floor": {"type": ["integer", "string"]},
+        "time_request": {"type": "string"},
+        "specific_features": {"type": "array", "items": {"type": "string"}},
+    },
+}
+
+# System prompts are built once and never contain the query, so they are identical on every call
+# and Ollama can reuse their cached prefix; the query is sent as the user message.
+SYSTEM_PROMPT = """
+You are an AI assistant helping parse user requests for finding workspaces.
+Your task is to extract key information from the user's query and return it as a JSON object.
+Focus on extracting the following fields if present:
+- desk_type: (e.g., "standing", "regular")
+- location_proximity: (e.g., "marketing team", "window", "quiet area") - specify the target of proximity.
+- floor: (e.g., "3rd", "2nd", number)
+- time_request: (e.g., "tomorrow afternoon", "now", "next Monday morning")
+- specific_features: (e.g., ["dual-monitor", "ergonomic-chair"]) - list any specific equipment mentioned.
+
+If a field is not mentioned, omit it from the JSON output.
+Respond ONLY with the JSON object, nothing else before or after.
+"""
+
+FIELD_PROMPT = """
+Extract the "{field}" {description} from the user's workspace request.
+Respond ONLY with a JSON object of the form {{"{field}": value}}, or {{}} if it is not mentioned.
+"""
+FIELD_SYSTEM_PROMPTS = {field: FIELD_PROMPT.format(field=field, description=description)
+                        for field, description in QUERY_FIELDS.items()}
+
+# Rule-based fast path: only queries that fully match this template skip Ollama (opt-in, so any other
+# wording - "or", "but", "far from", a second floor, extra features - goes to Ollama). It runs against
+# the normalized (lowercased, whitespace-collapsed) query, e.g.
+# "find me an available standing desk near the marketing team on the 3rd floor for tomorrow afternoon."
+FAST_PARSE_TEMPLATE = re.compile(
+    r"(?:(?:please )?(?:find|get|book) me )?(?:an? )?(?:available )?"
+    r"(?P<desk_type>standing|regular|sit-stand) desk "
+    r"near the marketing team "
+    r"on the (?P<floor>\d+(?:st|nd|rd|th)?) floor "
+    r"(?:for )?(?P<time_request>tomorrow (?:morning|afternoon|evening)|now|today)\.?"
+)
+DESK_TYPE_ALIASES = {"sit-stand": "standing"} # Map to the desk types used in desks.json
+
+JSON_HEADERS = {"Content-Type": "application/json"} # Payloads are pre-serialized with orjson
+
+# --- Ollama HTTP Session ---
+@st.cache_resource # Shared across reruns and sessions so connections stay pooled
+def get_ollama_session():
+    """Creates a requests.Session with a keep-alive connection pool for Ollama calls."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                          max_retries=Retry(total=2, backoff_factor=0.2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+_SESSION = get_ollama_session()
 
 # --- Check Ollama Connection ---
-@st.cache_resource(ttl=60) # Cache the check result for 60 seconds
+@st.cache_resource # Cache a successful check until it is cleared (Retry button or a failed Ollama call); failures are not kept
 def check_ollama_connection(url):
-    """Checks if the Ollama server is reachable."""
+    """Checks if the Ollama server is reachable and preloads the model so the first query is fast."""
     try:
         # Send a lightweight request, e.g., just check if the endpoint exists or get models list
         # Using a simple GET request to base URL often works for basic health check
         ping_url = url.replace("/api/generate", "") # Get base URL
-        response = requests.get(ping_url, timeout=3) # Short timeout
+        response = _SESSION.get(ping_url, timeout=(OLLAMA_CONNECT_TIMEOUT, 3)) # Short read timeout
         # A more robust check might be to list models: requests.get(url.replace("/api/generate", "/api/tags"))
         response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
         print("Ollama connection successful.")
-        return True
     except requests.exceptions.RequestException as e:
         print(f"Ollama connection failed: {e}")
         return False
 
-# Perform the check only once per session unless cache expires
+    try:
+        # Warm up: an empty prompt loads the model into memory without generating anything,
+        # so the first user query doesn't pay the model load time
+        warmup_payload = {"model": OLLAMA_MODEL, "prompt": "", "keep_alive": OLLAMA_KEEP_ALIVE,
+                          "stream": False, "options": OLLAMA_OPTIONS}
+        _SESSION.post(url, data=orjson.dumps(warmup_payload), headers=JSON_HEADERS, timeout=(OLLAMA_CONNECT_TIMEOUT, 60)).raise_for_status()
+        print(f"Ollama model '{OLLAMA_MODEL}' loaded.")
+    except requests.exceptions.RequestException as e:
+        # Not fatal: the model will be loaded on the first query instead
+        print(f"Ollama model warm-up failed: {e}")
+    return True
+
+# Perform the check only once per session; the cached result is shared until cleared
 if 'ollama_checked' not in st.session_state:
-     with st.spinner("Checking connection to local Ollama server..."):
+     with st.spinner("Checking connection to local Ollama server and loading the model..."):
         NLP_ENABLED = check_ollama_connection(OLLAMA_API_URL)
+        if not NLP_ENABLED:
+            check_ollama_connection.clear() # Only cache successful checks so new sessions re-check once Ollama is back
         st.session_state.ollama_checked = True
         st.session_state.nlp_enabled = NLP_ENABLED # Store in session state
 else:
@@ -47,82 +157,144 @@ else:
 if not NLP_ENABLED:
      st.warning(f"Could not connect to Ollama server at {OLLAMA_API_URL}. "
                f"Ensure Ollama is running and the model '{OLLAMA_MODEL}' is available. "
-               "NLP features will be disabled.", icon="")
+               "NLP features will be disabled; only queries matching the built-in template can be processed.", icon="")
+     if st.button("Retry connection"):
+        check_ollama_connection.clear()
+        del st.session_state.ollama_checked # Re-run the check on the next script run
+        st.rerun()
 
 # --- Helper Functions ---
 
-@st.cache_data  # Cache the data loading
+@st.cache_resource  # Cache the data loading; returns the same object without re-serializing (treat as read-only)
 def load_json_data(file_path):
-    """Loads JSON data from a file."""
+    """Loads JSON data from a file, parsing it straight from a read-only memory map."""
     try:
-        with open(file_path, 'r') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
     except FileNotFoundError:
         st.error(f"Error: Data file not found at {file_path}")
         return None
-    except json.JSONDecodeError:
+    except (orjson.JSONDecodeError, ValueError): # ValueError: an empty file cannot be memory-mapped
         st.error(f"Error: Could not decode JSON from {file_path}")
         return None
 
-def get_structured_query_from_nlp(natural_language_query):
-    """
-    Uses a local Ollama instance to parse the natural language query into a structured JSON object.
+def _chat_json(system_prompt, user_content, schema):
     """
-    if not NLP_ENABLED:
-         st.error("Ollama connection is not available. Cannot parse natural language query.")
-         return None
-
-    system_prompt = """
-    You are an AI assistant helping parse user requests for finding workspaces.
-    Your task is to extract key information from the user's query and return it as a JSON object.
-    Focus on extracting the following fields if present:
-    - desk_type: (e.g., "standing", "regular")
-    - location_proximity: (e.g., "marketing team", "window", "quiet area") - specify the target of proximity.
-    - floor: (e.g., "3rd", "2nd", number)
-    - time_request: (e.g., "tomorrow afternoon", "now", "next Monday morning")
-    - specific_features: (e.g., ["dual-monitor", "ergonomic-chair"]) - list any specific equipment mentioned.
-
-    If a field is not mentioned, omit it from the JSON output.
-    Respond ONLY with the JSON object, nothing else before or after.
-
-    User Query: "{query}"
-    JSON Output:
+    Sends a chat request to Ollama, streams the generated fragments back and parses them as JSON.
+    The system prompt goes first and unchanged so Ollama can reuse its cached prefix across calls.
+    Raises requests exceptions on transport errors and ValueError/orjson.JSONDecodeError on bad output.
     """
-    print(f"natural_language_query: {natural_language_query}")
-    full_prompt = system_prompt.format(query=natural_language_query)
-
     payload = {
         "model": OLLAMA_MODEL,
-        "prompt": full_prompt,
-        "format": "json",  # Request JSON output directly
-        "stream": False   # We want the full response at once
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ],
+        "format": schema,  # Grammar-constrained JSON output (requires Ollama >= 0.5)
+        "stream": True,   # Stream tokens back and assemble the JSON as it arrives
+        "options": OLLAMA_OPTIONS,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
     }
+    print(f"OLLAMA_CHAT_URL: {OLLAMA_CHAT_URL}")
+    print(f"payload: {payload}")
 
-    try:
-        print(f"OLLAMA_API_URL: {OLLAMA_API_URL}")
-        print(f"payload: {payload}")
-
-        response = requests.post(OLLAMA_API_URL, json=payload, timeout=120) # Increased timeout for generation
+    response_chunks = []
+    with _SESSION.post(OLLAMA_CHAT_URL, data=orjson.dumps(payload), headers=JSON_HEADERS, stream=True, timeout=(OLLAMA_CONNECT_TIMEOUT, 300)) as response:
         response.raise_for_status()  # Raise an exception for bad status codes
 
-        response_data = response.json()
-        # Ollama's response with format="json" should directly contain the JSON string in the 'response' field
-        json_string = response_data.get("response")
+        # Each line is a JSON object carrying the next fragment in its 'message.content' field
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = orjson.loads(line)
+            if "error" in chunk:
+                raise ValueError(f"Ollama returned an error: {chunk['error']}")
+            response_chunks.append(chunk.get("message", {}).get("content", ""))
+            if chunk.get("done"):
+                break
+
+    json_string = "".join(response_chunks)
+    if not json_string:
+        raise ValueError("Ollama response did not contain any message content.")
+
+    # Parse the JSON string assembled from the streamed fragments
+    return orjson.loads(json_string)
+
+def _extract_field(field, natural_language_query):
+    """Asks Ollama for a single field of the structured query. Returns {} if the field is absent."""
+    field_schema = {"type": "object", "properties": {field: QUERY_SCHEMA["properties"][field]}}
+    result = _chat_json(FIELD_SYSTEM_PROMPTS[field], natural_language_query, field_schema)
+    if isinstance(result, dict) and result.get(field) not in (None, "", []):
+        return {field: result[field]}
+    return {}
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False) # Repeated queries skip Ollama entirely
+def _parse_query_cached(normalized_query):
+    """
+    Parses a normalized query with Ollama. Errors propagate to the caller so failed parses are not cached.
+    When OLLAMA_NUM_PARALLEL > 1, each field is extracted by its own small prompt and the
+    requests are issued concurrently; otherwise a single prompt extracts all fields.
+    """
+    if OLLAMA_NUM_PARALLEL > 1:
+        # Fan out one small extraction prompt per field; Ollama serves them in parallel
+        with ThreadPoolExecutor(max_workers=min(OLLAMA_NUM_PARALLEL, len(QUERY_FIELDS))) as executor:
+            futures = [executor.submit(_extract_field, field, normalized_query) for field in QUERY_FIELDS]
+            structured_query = {}
+            for future in futures:
+                structured_query.update(future.result())
+        return structured_query
+
+    return _chat_json(SYSTEM_PROMPT, normalized_query, QUERY_SCHEMA)
+
+def _fast_parse(normalized_query):
+    """
+    Parses a query that fully matches FAST_PARSE_TEMPLATE without calling Ollama.
+    Returns None for anything else, so it is parsed by Ollama instead.
+    """
+    match = FAST_PARSE_TEMPLATE.fullmatch(normalized_query)
+    if not match:
+        return None
+
+    desk_type = match.group("desk_type")
+    return {
+        "desk_type": DESK_TYPE_ALIASES.get(desk_type, desk_type),
+        "location_proximity": "marketing team",
+        "floor": match.group("floor"),
+        "time_request": match.group("time_request"),
+    }
+
+def get_structured_query_from_nlp(natural_language_query):
+    """
+    Parses the natural language query into a structured JSON object.
+    Common query shapes are handled by a rule-based parser; anything else goes to the local Ollama instance.
+    Results are cached per normalized query (lowercased, whitespace collapsed).
+    """
+    print(f"natural_language_query: {natural_language_query}")
+    normalized_query = " ".join(natural_language_query.lower().split())
+
+    structured_query = _fast_parse(normalized_query)
+    if structured_query:
+        print(f"Parsed without Ollama: {structured_query}")
+        return structured_query
 
-        if not json_string:
-             st.error(f"Ollama response did not contain the expected 'response' field. Full response: {response_data}")
-             return None
+    if not NLP_ENABLED:
+         st.error("Ollama connection is not available, and the query doesn't match the built-in template. Cannot parse natural language query.")
+         return None
 
-        # Parse the JSON string returned by Ollama
-        return json.loads(json_string)
+    try:
+        return _parse_query_cached(normalized_query)
 
     except requests.exceptions.Timeout:
          st.error(f"Request to Ollama timed out. The server might be busy or the model is taking too long.")
          return None
+    except requests.exceptions.ChunkedEncodingError as e:
+         st.error(f"The response stream from Ollama was interrupted. Please try again. Error: {e}")
+         return None
     except requests.exceptions.ConnectionError:
          st.error(f"Could not connect to Ollama server at {OLLAMA_API_URL}. Is it running?")
          # Optionally disable NLP for the rest of the session
          st.session_state.nlp_enabled = False
+         check_ollama_connection.clear() # Don't let other sessions reuse the stale "connected" result
          st.rerun() # Rerun to show the warning
          return None
     except requests.exceptions.RequestException as e:
@@ -131,36 +303,80 @@ def get_structured_query_from_nlp(natural_language_query):
         st.session_state.nlp_enabled = False
         st.rerun()
         return None
-    except json.JSONDecodeError as e:
-        st.error(f"Ollama returned a response, but it was not valid JSON. Response text: '{json_string}'. Error: {e}")
+    except orjson.JSONDecodeError as e:
+        st.error(f"Ollama returned a response, but it was not valid JSON. Response text: '{e.doc}'. Error: {e}")
         return None
     except Exception as e:
         st.error(f"An unexpected error occurred while processing the Ollama response: {e}")
         return None
 
 
-def find_marketing_zone_areas(spaces_data):
+@st.cache_data # Rendered once per file, not on every rerun while the sidebar checkbox is ticked
+def render_json_file(file_path):
+    """Returns the loaded data of a JSON file pretty-printed for display."""
+    return orjson.dumps(load_json_data(file_path), option=orjson.OPT_INDENT_2).decode()
+
+@st.cache_resource # Built once per spaces file; keyed on the path so the data itself is never hashed or copied
+def _build_space_indexes(file_path=SPACES_FILE):
+    """
+    Indexes spaces in a single pass: parent ID -> child spaces, and (name, type) -> space ID.
+    """
+    parent_index = defaultdict(list)
+    name_index = {}
+    for space in (load_json_data(file_path) or {}).get("spaces", []):
+        parent_index[space.get("parent_id")].append(space)
+        name_index.setdefault((space.get("name"), space.get("type")), space.get("id")) # First match wins
+    return dict(parent_index), name_index
+
+@st.cache_resource # Built once per desks file; keyed on the path so the data itself is never hashed or copied
+def _build_desks_frame(file_path=DESKS_FILE):
+    """
+    Loads the desks into a DataFrame (row index = position in the desks list) for vectorized filtering.
+    The returned frame is shared across reruns and sessions, so treat it as read-only.
+    """
+    desks_df = pd.json_normalize((load_json_data(file_path) or {}).get("desks", []))
+    for column in ("type", "floor", "area_id"): # Filter columns must exist even if no desk sets them
+        if column not in desks_df:
+            desks_df[column] = None
+    return desks_df
+
+def find_marketing_zone_areas(spaces_file=SPACES_FILE):
     """Finds the area IDs associated with the Marketing Zone."""
-    marketing_zone_id = None
-    for space in spaces_data.get("spaces", []):
-        if space.get("name") == "Marketing Zone" and space.get("type") == "zone":
-            marketing_zone_id = space.get("id")
-            break
+    parent_index, name_index = _build_space_indexes(spaces_file)
+    marketing_zone_id = name_index.get(("Marketing Zone", "zone"))
 
     if not marketing_zone_id:
         return []
 
-    marketing_area_ids = []
-    for space in spaces_data.get("spaces", []):
-        if space.get("parent_id") == marketing_zone_id and space.get("type") == "area":
-            marketing_area_ids.append(space.get("id"))
+    return [space.get("id") for space in parent_index.get(marketing_zone_id, []) if space.get("type") == "area"]
 
-    return marketing_area_ids
+@st.cache_resource # Parsed once per policies file; keyed on the path so the data itself is never hashed or copied
+def _parse_policy_thresholds(file_path=POLICIES_FILE):
+    """
+    Maps policy IDs to the first percentage in their description, as a numeric threshold.
+    """
+    thresholds = {}
+    for policy in (load_json_data(file_path) or {}).get("policies", []):
+        match = re.search(r"(\d+)%", policy.get("description", ""))
+        if match:
+            thresholds[policy.get("id")] = int(match.group(1))
+    return thresholds
+
+@st.cache_resource # Built once per occupancy file; keyed on the path so the data itself is never hashed or copied
+def _build_afternoon_forecast(file_path=OCCUPANCY_FILE):
+    """Flattens the forecast into {area_id: next-day afternoon occupancy %}."""
+    return {
+        area_id: area_forecast["next_day"].get("afternoon")
+        for area_id, area_forecast in (load_json_data(file_path) or {}).get("forecast", {}).items()
+        if "next_day" in area_forecast
+    }
 
-def check_desk_availability(desk, time_request, occupancy_data, policies):
+def check_desk_availability(desk, time_request, afternoon_forecast, capacity_threshold):
     """
     Checks if a desk is likely available based on status and forecast.
     Simplification: For "tomorrow afternoon", checks forecast. Ignores specific booking times.
+    afternoon_forecast maps area IDs to tomorrow's afternoon occupancy forecast (see _build_afternoon_forecast).
+    capacity_threshold is the forecast occupancy percentage at which an area counts as full.
     """
     # 1. Check current status - Maintenance blocks immediately
     if desk.get("status") == "maintenance":
@@ -169,29 +385,22 @@ def check_desk_availability(desk, time_request, occupancy_data, policies):
     # 2. Check forecast for "tomorrow afternoon"
     if time_request == "tomorrow afternoon":
         area_id = desk.get("vergesense_area_id")
-        forecast_data = occupancy_data.get("forecast", {}).get(area_id, {}).get("next_day", {})
-        forecast = forecast_data.get("afternoon") # Directly access "afternoon"
-
+        forecast = afternoon_forecast.get(area_id)
 
         if forecast is None:
             # No forecast data for this area/time - conservative approach: assume unavailable
              return False, f"No 'afternoon' forecast data available for Area {area_id} tomorrow."
 
-        # Check against capacity limits policy (e.g., POL-005 threshold)
-        capacity_policy = next((p for p in policies.get("policies", []) if p.get("id") == "POL-005"), None)
-        threshold = 80 # Default threshold if policy not found or doesn't specify numeric limit easily
-        if capacity_policy and "80%" in capacity_policy.get("description", ""): # Simple check
-             threshold = 80
-
-        if forecast >= threshold:
-             return False, f"Area {area_id} forecasted occupancy ({forecast}%) meets/exceeds threshold ({threshold}%) for tomorrow afternoon."
+        # Check against capacity limits policy (POL-005 threshold, parsed once by the caller)
+        if forecast >= capacity_threshold:
+             return False, f"Area {area_id} forecasted occupancy ({forecast}%) meets/exceeds threshold ({capacity_threshold}%) for tomorrow afternoon."
 
         # Desk Sanitization Policy (POL-002) - Simple check: Not implemented in detail for prototype
         # For "tomorrow afternoon", this is unlikely to conflict unless used very late today.
 
         # If forecast is below threshold, we *assume* the desk *might* be available.
         # A real system needs actual booking data.
-        return True, f"Area {area_id} forecast ({forecast}%) is below threshold ({threshold}%) for tomorrow afternoon. Desk *may* be available."
+        return True, f"Area {area_id} forecast ({forecast}%) is below threshold ({capacity_threshold}%) for tomorrow afternoon. Desk *may* be available."
 
     # 3. Handle other time requests (e.g., "now") - simplified: check current status
     elif time_request == "now": # Example for extendibility
@@ -205,25 +414,12 @@ def check_desk_availability(desk, time_request, occupancy_data, policies):
 
 
 # --- Load Data ---
-# Attempt to load data only if not already loaded and errored
-if 'data_loaded' not in st.session_state:
-    spaces_data = load_json_data(SPACES_FILE)
-    occupancy_data = load_json_data(OCCUPANCY_FILE)
-    desks_data = load_json_data(DESKS_FILE)
-    employee_prefs_data = load_json_data(EMPLOYEE_PREFS_FILE) # Load if needed later
-    policies_data = load_json_data(POLICIES_FILE)
-    st.session_state.data_loaded = True # Mark data as loaded (or attempted)
-    st.session_state.spaces_data = spaces_data
-    st.session_state.occupancy_data = occupancy_data
-    st.session_state.desks_data = desks_data
-    st.session_state.policies_data = policies_data
-    st.session_state.employee_prefs_data = employee_prefs_data
-else:
-    spaces_data = st.session_state.spaces_data
-    occupancy_data = st.session_state.occupancy_data
-    desks_data = st.session_state.desks_data
-    policies_data = st.session_state.policies_data
-    employee_prefs_data = st.session_state.employee_prefs_data
+# load_json_data is a cache_resource, so every rerun and session shares the same read-only objects
+spaces_data = load_json_data(SPACES_FILE)
+occupancy_data = load_json_data(OCCUPANCY_FILE)
+desks_data = load_json_data(DESKS_FILE)
+employee_prefs_data = load_json_data(EMPLOYEE_PREFS_FILE) # Load if needed later
+policies_data = load_json_data(POLICIES_FILE)
 
 
 # --- Streamlit UI ---
@@ -240,17 +436,15 @@ if st.button("Find Workspace"):
         st.warning("Please enter a query.")
     elif not all([spaces_data, occupancy_data, desks_data, policies_data]):
          st.error("Could not load all necessary data files. Please check the `data` directory and restart.")
-    elif not NLP_ENABLED:
-         st.error("Ollama NLP features are disabled (connection failed or not configured). Cannot process the request.")
     else:
         with st.spinner("Processing your request... (Parsing Query -> Filtering Desks -> Checking Availability)"):
 
             # 1. Parse Natural Language Query using AI
-            st.subheader("1. Parsing Natural Language Query (via Ollama)")
+            st.subheader("1. Parsing Natural Language Query (rule-based, falling back to Ollama)")
             structured_query = get_structured_query_from_nlp(nl_query)
 
             if not structured_query:
-                st.error("Failed to parse the natural language query using Ollama.")
+                st.error("Failed to parse the natural language query.")
             else:
                 st.json(structured_query) # Display the JSON output from Ollama
 
@@ -276,37 +470,54 @@ if st.button("Find Workspace"):
                 if desks_data is None:
                     st.error("Desks data is not loaded. Cannot filter.")
                 else:
-                    candidate_desks = desks_data.get("desks", [])
-                    filtered_desks = []
+                    desks_array = desks_data.get("desks", [])
+                    desks_df = _build_desks_frame(DESKS_FILE)
+                    mask = pd.Series(True, index=desks_df.index) # Desks still matching
                     filter_log = [] # Log reasons for filtering
 
                     # --- Filtering Steps ---
-                    initial_count = len(candidate_desks)
+                    initial_count = len(desks_df)
                     filter_log.append(f"Starting with {initial_count} total desks.")
 
+                    # Each stage returns (mask, log message); a None mask means the stage only logs a note.
+                    # Stages run lazily so later ones are skipped once no desks remain.
+                    filter_stages = []
+
                     # Filter by Type
                     if req_desk_type:
-                        candidate_desks = [d for d in candidate_desks if d.get("type") == req_desk_type]
-                        filter_log.append(f"Filtered by type '{req_desk_type}': {len(candidate_desks)} remaining.")
+                        filter_stages.append(lambda: (desks_df["type"] == req_desk_type, f"Filtered by type '{req_desk_type}'"))
 
                     # Filter by Floor
                     if req_floor is not None:
-                        candidate_desks = [d for d in candidate_desks if d.get("floor") == req_floor]
-                        filter_log.append(f"Filtered by floor '{req_floor}': {len(candidate_desks)} remaining.")
+                        filter_stages.append(lambda: (desks_df["floor"] == req_floor, f"Filtered by floor '{req_floor}'"))
 
                     # Filter by Proximity (Marketing Team specific implementation)
                     if req_proximity and req_proximity.lower() == "marketing team":
-                        if spaces_data: # Check if spaces_data loaded correctly
-                            marketing_area_ids = find_marketing_zone_areas(spaces_data)
+                        def marketing_proximity_stage():
+                            if not spaces_data: # Check if spaces_data loaded correctly
+                                return None, "Warning: Spaces data not loaded, cannot filter by proximity."
+                            marketing_area_ids = find_marketing_zone_areas(SPACES_FILE)
                             if not marketing_area_ids:
-                                filter_log.append("Warning: Could not find areas associated with 'Marketing Zone'. Skipping proximity filter.")
-                            else:
-                                candidate_desks = [d for d in candidate_desks if d.get("area_id") in marketing_area_ids]
-                                filter_log.append(f"Filtered by proximity to 'Marketing Team' (Areas: {', '.join(marketing_area_ids)}): {len(candidate_desks)} remaining.")
-                        else:
-                             filter_log.append("Warning: Spaces data not loaded, cannot filter by proximity.")
+                                return None, "Warning: Could not find areas associated with 'Marketing Zone'. Skipping proximity filter."
+                            return (desks_df["area_id"].isin(marketing_area_ids),
+                                    f"Filtered by proximity to 'Marketing Team' (Areas: {', '.join(marketing_area_ids)})")
+                        filter_stages.append(marketing_proximity_stage)
                     elif req_proximity:
-                        filter_log.append(f"Note: Proximity filter for '{req_proximity}' not specifically implemented in this prototype.")
+                        filter_stages.append(lambda: (None, f"Note: Proximity filter for '{req_proximity}' not specifically implemented in this prototype."))
+
+                    for stage in filter_stages:
+                        if not mask.any():
+                            filter_log.append("No desks remaining; skipping the remaining filters.")
+                            break
+                        stage_mask, message = stage()
+                        if stage_mask is None:
+                            filter_log.append(message)
+                            continue
+                        mask &= stage_mask
+                        filter_log.append(f"{message}: {mask.sum()} remaining.")
+
+                    candidate_df = desks_df[mask]
+                    candidate_desks = [desks_array[i] for i in candidate_df.index] # Original desk dicts, in order
 
 
                     # --- Log Filtering Steps ---
@@ -315,7 +526,7 @@ if st.button("Find Workspace"):
                             st.write(log_entry)
                         st.write(f"**Candidate desks after initial filters:** {len(candidate_desks)}")
                         if candidate_desks:
-                            st.dataframe(candidate_desks, use_container_width=True)
+                            st.dataframe(candidate_df, use_container_width=True)
 
 
                     # 3. Check Availability & Policies for remaining candidates
@@ -328,11 +539,23 @@ if st.button("Find Workspace"):
                     elif occupancy_data is None or policies_data is None:
                          st.error("Occupancy or Policies data not loaded. Cannot check availability.")
                     else:
-                        for desk in candidate_desks:
-                            is_available, reason = check_desk_availability(desk, req_time, occupancy_data, policies_data)
+                        policy_thresholds = _parse_policy_thresholds(POLICIES_FILE)
+                        capacity_threshold = policy_thresholds.get("POL-005", DEFAULT_CAPACITY_THRESHOLD)
+                        afternoon_forecast = _build_afternoon_forecast(OCCUPANCY_FILE)
+                        def check_candidate(desk):
+                            return check_desk_availability(desk, req_time, afternoon_forecast, capacity_threshold)
+
+                        if len(candidate_desks) > PARALLEL_CHECK_MIN_DESKS:
+                            # Large candidate sets: spread the checks over a thread pool (map keeps the desk order)
+                            with ThreadPoolExecutor(max_workers=AVAILABILITY_CHECK_WORKERS) as executor:
+                                results = list(executor.map(check_candidate, candidate_desks))
+                        else:
+                            results = [check_candidate(desk) for desk in candidate_desks]
+
+                        for desk, (is_available, reason) in zip(candidate_desks, results):
                             availability_log.append(f"Desk {desk.get('id')}: Available = {is_available}. Reason: {reason}")
                             if is_available:
-                                available_desks.append(desk)
+                                available_desks.append((desk, reason)) # Keep the reason for the recommendation details
 
                         with st.expander("Availability Check Log"):
                             for log_entry in availability_log:
@@ -344,19 +567,18 @@ if st.button("Find Workspace"):
                         st.success(f"Found {len(available_desks)} potentially suitable desk(s) for '{req_time}':")
 
                         # Simple Recommendation: Show the first few available desks
-                        st.dataframe(available_desks, use_container_width=True)
+                        st.dataframe([desk for desk, _ in available_desks], use_container_width=True)
 
                         # Provide details of the first recommendation
+                        top_desk, positive_reason = available_desks[0]
                         st.markdown("---")
-                        st.markdown(f"**Top Recommendation:** Desk **{available_desks[0].get('id')}**")
-                        st.markdown(f"*   **Location:** {available_desks[0].get('location_description', 'N/A')}")
-                        st.markdown(f"*   **Area:** {available_desks[0].get('area_id')} ({available_desks[0].get('zone')})")
-                        st.markdown(f"*   **Type:** {available_desks[0].get('type')}")
-                        st.markdown(f"*   **Features:** {', '.join(available_desks[0].get('features', []))}")
+                        st.markdown(f"**Top Recommendation:** Desk **{top_desk.get('id')}**")
+                        st.markdown(f"*   **Location:** {top_desk.get('location_description', 'N/A')}")
+                        st.markdown(f"*   **Area:** {top_desk.get('area_id')} ({top_desk.get('zone')})")
+                        st.markdown(f"*   **Type:** {top_desk.get('type')}")
+                        st.markdown(f"*   **Features:** {', '.join(top_desk.get('features', []))}")
                         # Add the positive availability reason
-                        if occupancy_data and policies_data:
-                             _ , positive_reason = check_desk_availability(available_desks[0], req_time, occupancy_data, policies_data)
-                             st.markdown(f"*   **Availability Note:** {positive_reason}")
+                        st.markdown(f"*   **Availability Note:** {positive_reason}")
 
 
                     else:
@@ -365,12 +587,12 @@ if st.button("Find Workspace"):
 # Optional: Display loaded data for transparency/debugging
 st.sidebar.subheader("Loaded Mock Data")
 if spaces_data and st.sidebar.checkbox("Show Spaces Data"):
-    st.sidebar.json(spaces_data)
+    st.sidebar.code(render_json_file(SPACES_FILE), language="json")
 if occupancy_data and st.sidebar.checkbox("Show Occupancy/Forecast Data"):
-    st.sidebar.json(occupancy_data)
+    st.sidebar.code(render_json_file(OCCUPANCY_FILE), language="json")
 if desks_data and st.sidebar.checkbox("Show Desks Data"):
-    st.sidebar.json(desks_data)
+    st.sidebar.code(render_json_file(DESKS_FILE), language="json")
 if policies_data and st.sidebar.checkbox("Show Policies Data"):
-    st.sidebar.json(policies_data)
-if policies_data and st.sidebar.checkbox("Show Employee Preferences Data"):
-    st.sidebar.json(employee_prefs_data)
\ No newline at end of file
+    st.sidebar.code(render_json_file(POLICIES_FILE), language="json")
+if employee_prefs_data and st.sidebar.checkbox("Show Employee Preferences Data"):
+    st.sidebar.code(render_json_file(EMPLOYEE_PREFS_FILE), language="json")
\ No newline at end of file